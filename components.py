@@ -3,15 +3,16 @@
 ・両モードで参照ドキュメントのありかとページ番号を表示
 ・LLM 応答の形式に依存しないよう、多様なレスポンス形状をハンドリング
 """
-from typing import Any, Dict, Iterable, List, Optional, Tuple
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple, TypedDict
 import re
 import os
-import glob
+import codecs
+import functools
+import itertools
+import mmap
 import unicodedata
 import streamlit as st
 import constants as ct
-from langchain_community.document_loaders import PyMuPDFLoader, Docx2txtLoader, TextLoader
-from langchain_community.document_loaders.csv_loader import CSVLoader
 
 
 def display_app_title():
@@ -47,23 +48,28 @@ def display_select_mode():
     )
 
 
+class Turn(TypedDict):
+    """One entry of st.session_state.turns.
+
+    user: the question / assistant: text shown in the log (None until answered)
+    answer: the LLM's own answer, sent back as chat history (None when the LLM was not used)
+    """
+    user: str
+    assistant: Optional[str]
+    answer: Optional[str]
+
+
 def display_initial_ai_message():
-    if "messages" not in st.session_state:
-        st.session_state.messages = []
-    if not st.session_state.messages:
-        st.session_state.messages.append({"role": "assistant", "content": "どうぞ質問してください。"})
+    if not st.session_state.get("turns"):
+        st.chat_message("assistant").markdown("どうぞ質問してください。")
 
 
 def display_conversation_log():
-    for msg in st.session_state.get("messages", []):
-        role = msg.get("role")
-        content = msg.get("content")
-        if role == "user":
-            with st.chat_message("user"):
-                st.markdown(content)
-        else:
-            with st.chat_message("assistant"):
-                st.markdown(content)
+    # Streamlit は rerun ごとに画面を描き直すため、過去ログも毎回すべて描画する必要がある
+    for turn in st.session_state.get("turns", []):
+        st.chat_message("user").markdown(turn["user"])
+        if turn.get("assistant") is not None:
+            st.chat_message("assistant").markdown(turn["assistant"])
 
 
 def display_search_llm_response(resp):
@@ -275,23 +281,16 @@ def _extract_lines_from_source_documents(sources: List[Dict[str, Any]], keywords
         if not resolved or not os.path.exists(resolved):
             continue
         ext = os.path.splitext(resolved)[1].lower()
-        loader = None
+        if ext not in (".pdf", ".docx", ".txt"):
+            continue
         try:
-            if ext == ".pdf":
-                loader = PyMuPDFLoader(resolved)
-            elif ext == ".docx":
-                loader = Docx2txtLoader(resolved)
-            elif ext == ".txt":
-                loader = TextLoader(resolved, encoding="utf-8")
-            else:
-                continue
-            docs = loader.load()
-        except Exception:
+            docs = _load_doc_cached(resolved, os.stat(resolved).st_mtime, ext)
+        except OSError:
             continue
         # Scan lines for keywords
         picked = 0
         for d in docs:
-            text = str(getattr(d, "page_content", ""))
+            text = str(d.get("page_content", ""))
             for ln in text.splitlines():
                 if any(k in ln for k in keywords):
                     norm = ln.strip()
@@ -315,6 +314,20 @@ def detect_dept_listing(prompt: str, dept_name: str = "人事部") -> bool:
     return get_department_from_prompt(prompt) is not None
 
 
+# Known department candidates (including some common variants)
+_KNOWN_DEPARTMENTS = (
+    "人事部", "総務部", "経理部", "財務部", "営業部", "マーケティング部", "広報部", "法務部",
+    "開発部", "技術部", "情報システム部", "IT部", "品質保証部", "製造部", "購買部", "企画部",
+    "サポート部", "カスタマーサポート部", "CS部", "事業部", "本部",
+)
+# 部署を表すとみなすカラム名の部分文字列
+_DEPT_COL_TOKENS = ("部署", "部門", "所属", "部")
+
+
+def _dept_columns(cols: Iterable[str]) -> List[str]:
+    return [c for c in cols if any(k in c for k in _DEPT_COL_TOKENS)]
+
+
 def get_department_from_prompt(prompt: str) -> Optional[str]:
     """Extract department-like name from a prompt (e.g., 営業部, マーケティング部, 人事部, 開発部, 事業部, 本部, 課, 室).
 
@@ -323,13 +336,7 @@ def get_department_from_prompt(prompt: str) -> Optional[str]:
     if not isinstance(prompt, str) or not prompt:
         return None
     p = prompt.strip()
-    # Known department candidates (including some common variants)
-    known = [
-        "人事部", "総務部", "経理部", "財務部", "営業部", "マーケティング部", "広報部", "法務部",
-        "開発部", "技術部", "情報システム部", "IT部", "品質保証部", "製造部", "購買部", "企画部",
-        "サポート部", "カスタマーサポート部", "CS部", "事業部", "本部"
-    ]
-    for k in known:
+    for k in _KNOWN_DEPARTMENTS:
         if k in p:
             return k
     # Generic pattern: <word>(本部|事業部|部|課|室)
@@ -345,55 +352,38 @@ def render_department_listing_from_data_root(dept_name: str, min_rows: int = 4)
     Returns True if rendered, False otherwise.
     """
     try:
-        data_root = getattr(ct, "RAG_TOP_FOLDER_PATH", "./data")
-        pattern = os.path.join(data_root, "**", "*.csv")
-        csvs = [p for p in glob.glob(pattern, recursive=True) if os.path.isfile(p)]
+        csvs = [p for p in _data_root_files() if _is_csv_path(p)]
         if not csvs:
             return False
         # Try pandas first
-        try:
-            import pandas as pd  # type: ignore
-        except Exception:
-            pd = None  # type: ignore
+        pd = _get_pandas()
 
         # Search each CSV for dept rows
         for path in csvs:
             if pd is not None:
-                df = None
-                for enc in ("utf-8", "utf-8-sig", "cp932"):
-                    try:
-                        df = pd.read_csv(path, encoding=enc)
-                        break
-                    except Exception:
-                        continue
+                df, dept_cols = _read_csv(path)
                 if df is None or df.empty:
                     continue
-                cols = [str(c) for c in df.columns]
-                dept_cols = [c for c in cols if any(k in c for k in ["部署", "部門", "所属", "部"])]
                 if dept_cols:
-                    mask = False
-                    for c in dept_cols:
-                        mask = mask | (df[c].astype(str) == dept_name)
+                    mask = _mask_by_dept(df, dept_cols, dept_name)
                     sub = df.loc[mask]
                     # If too few rows, fallback to contains
                     if sub is None or len(sub) < min_rows:
-                        mask2 = False
-                        for c in dept_cols:
-                            mask2 = mask2 | (df[c].astype(str).str.contains(dept_name, na=False))
+                        mask2 = _mask_contains_in_columns(df, dept_cols, dept_name)
                         sub = df.loc[mask2]
                 else:
-                    mask = df.apply(lambda row: row.astype(str).str.contains(dept_name, na=False).any(), axis=1)
+                    mask = _mask_contains_in_columns(df, df.columns, dept_name)
                     sub = df.loc[mask]
                 if sub is None or sub.empty or len(sub) < min_rows:
                     continue
                 st.markdown(f"### {dept_name} の従業員一覧 (CSV 検索)")
-                st.dataframe(sub, use_container_width=True)
+                st.dataframe(_listing_frame(sub), use_container_width=True, hide_index=True)
                 return True
             else:
                 import csv
                 rows: List[dict] = []
                 read_ok = False
-                for enc in ("utf-8", "utf-8-sig", "cp932"):
+                for enc in _csv_encodings(path):
                     try:
                         with open(path, "r", encoding=enc, newline="") as f:
                             reader = csv.DictReader(f)
@@ -405,7 +395,7 @@ def render_department_listing_from_data_root(dept_name: str, min_rows: int = 4)
                 if not read_ok or not rows:
                     continue
                 cols = list(rows[0].keys()) if rows else []
-                dept_cols = [c for c in cols if any(k in c for k in ["部署", "部門", "所属", "部"])]
+                dept_cols = _dept_columns(cols)
                 def row_matches(r: dict) -> bool:
                     if dept_cols:
                         # equality first
@@ -424,15 +414,7 @@ def render_department_listing_from_data_root(dept_name: str, min_rows: int = 4)
                 if len(sub_rows) < min_rows:
                     continue
                 st.markdown(f"### {dept_name} の従業員一覧 (CSV 検索)")
-                table_cols = list({k for r in sub_rows for k in r.keys()})
-                if table_cols:
-                    header = "| " + " | ".join(table_cols) + " |"
-                    sep = "|" + "|".join([" --- "] * len(table_cols)) + "|"
-                    st.markdown(header)
-                    st.markdown(sep)
-                    for r in sub_rows:
-                        row = [str(r.get(c, "")) for c in table_cols]
-                        st.markdown("| " + " | ".join(row) + " |")
+                _render_markdown_table(sub_rows)
                 return True
     except Exception:
         return False
@@ -444,37 +426,44 @@ def render_keyword_search_fallback(query: str, max_hits: int = 5) -> bool:
 
     Returns True if any hits are displayed.
     """
-    data_root = getattr(ct, "RAG_TOP_FOLDER_PATH", "./data")
-    exts_map = getattr(ct, "SUPPORTED_EXTENSIONS", {
-        ".pdf": PyMuPDFLoader,
-        ".docx": Docx2txtLoader,
-        ".txt": lambda p: TextLoader(p, encoding="utf-8"),
-        ".csv": lambda p: CSVLoader(p, encoding="utf-8"),
-    })
     lower_q = str(query).strip().lower()
     if not lower_q:
         return False
-
-    def iter_files(root: str):
-        for dirpath, _, filenames in os.walk(root):
-            for fn in filenames:
-                yield os.path.join(dirpath, fn)
+    # ASCII クエリは大文字小文字無視の正規表現で直接探索し、本文ごとの lower() コピーを避ける
+    ascii_re = re.compile(re.escape(lower_q), re.IGNORECASE | re.ASCII) if lower_q.isascii() else None
+
+    def contains_query(text: str) -> bool:
+        if ascii_re is not None:
+            return ascii_re.search(text) is not None
+        return lower_q in text.lower()
+
+    # .txt はローダーの出力がファイルの中身そのものなので、読み込む前にバイト列で事前判定する
+    # （大文字小文字が無い/ASCII のクエリのみ）。CSV はローダーが「列名: 値」の行に整形するため対象外
+    q_bytes = lower_q.encode("utf-8")
+    bytes_re = (
+        re.compile(re.escape(q_bytes), re.IGNORECASE)
+        if lower_q.isascii() or lower_q.upper() == lower_q
+        else None
+    )
 
     hits: List[Dict[str, Any]] = []
-    for path in iter_files(data_root):
+    for path in _data_root_files():
         ext = os.path.splitext(path)[1].lower()
-        if ext not in exts_map:
+        if _get_loader(ext) is None:
             continue
         try:
-            loader_ctor = exts_map[ext]
-            loader = loader_ctor(path)
-            docs = loader.load()
-        except Exception:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        if stat.st_size < len(q_bytes):
+            continue
+        if bytes_re is not None and ext == ".txt" and not _file_may_contain(path, bytes_re):
             continue
+        docs = _load_doc_cached(path, stat.st_mtime, ext)
         for d in docs:
-            text = str(getattr(d, "page_content", ""))
-            if lower_q in text.lower():
-                meta = getattr(d, "metadata", {}) or {}
+            text = str(d.get("page_content", ""))
+            if contains_query(text):
+                meta = d.get("metadata") or {}
                 src = meta.get("source") or meta.get("file_path") or meta.get("path") or meta.get("url") or path
                 page = meta.get("page_number") or meta.get("page")
                 hits.append({
@@ -496,10 +485,252 @@ def render_keyword_search_fallback(query: str, max_hits: int = 5) -> bool:
     return True
 
 
+def offtopic_message(mode: str) -> str:
+    """Fixed reply for inputs unrelated to company documents, per answer mode."""
+    if mode == ct.ANSWER_MODE_1:
+        return "入力内容と関連する社内文書が見つかりませんでした"
+    return getattr(ct, "INQUIRY_NO_MATCH_ANSWER", "回答に必要な情報が見つかりませんでした。")
+
+
+# OpenAI quota / rate-limit errors (matched against str(exception))
+_QUOTA_RE = re.compile(r"insufficient_quota|You exceeded your current quota|Error code: 429")
+
+
+def is_quota_error(msg: str) -> bool:
+    return _QUOTA_RE.search(msg) is not None
+
+
+def handle_llm_error(error: Exception, chat_message: str, mode: str) -> None:
+    """Render a fallback answer after the LLM call failed.
+
+    Handlers named in ct.LLM_ERROR_FALLBACKS are tried in order and the first one that
+    renders something wins; otherwise the error message is shown.
+    """
+    for name in getattr(ct, "LLM_ERROR_FALLBACKS", _DEFAULT_LLM_ERROR_FALLBACKS):
+        handler = _LLM_ERROR_HANDLERS.get(name)
+        if handler is not None and handler(error, chat_message, mode):
+            return
+    st.error(_build_error_message(f"エラーが発生しました: {error}"))
+
+
+def _fallback_offtopic(error: Exception, chat_message: str, mode: str) -> bool:
+    # If off-topic (e.g., 天気/雑談), prefer fixed message over other fallbacks
+    if getattr(ct, "ALLOW_OFFTOPIC_LLM", True) or not _looks_unrelated_to_corp_docs(chat_message, []):
+        return False
+    with st.chat_message("assistant"):
+        st.warning(offtopic_message(mode))
+    return True
+
+
+def _fallback_dept_listing(error: Exception, chat_message: str, mode: str) -> bool:
+    # Quota error on a department listing request: search the roster CSV directly
+    if not is_quota_error(str(error)) or not detect_dept_listing(chat_message, dept_name=None):
+        return False
+    with st.chat_message("assistant"):
+        dept = get_department_from_prompt(chat_message) or "人事部"
+        rendered = render_department_listing_from_data_root(dept, min_rows=4)
+        if not rendered:
+            st.warning("部署一覧のCSV検索に失敗しました。")
+    return True
+
+
+def _fallback_keyword_search(error: Exception, chat_message: str, mode: str) -> bool:
+    # Quota error on a general query: naive keyword search over data/
+    if not is_quota_error(str(error)):
+        return False
+    with st.chat_message("assistant"):
+        rendered = render_keyword_search_fallback(chat_message, max_hits=5)
+        if not rendered:
+            st.error(_build_error_message(f"エラーが発生しました: {error}"))
+    return True
+
+
+_LLM_ERROR_HANDLERS = {
+    "offtopic": _fallback_offtopic,
+    "dept_listing": _fallback_dept_listing,
+    "keyword_search": _fallback_keyword_search,
+}
+_DEFAULT_LLM_ERROR_FALLBACKS = ("offtopic", "dept_listing", "keyword_search")
+
+
 # =========================
 # internal helpers
 # =========================
 
+def _build_error_message(message: str) -> str:
+    # utils は LangChain を import するため、エラー表示時にだけ読み込む
+    from utils import build_error_message
+    return build_error_message(message)
+
+
+# レスポンスから回答テキスト／参照ドキュメントを探すキー（優先順）
+_TEXT_KEYS = ("answer", "content", "text", "output_text", "result", "message", "response")
+_SRC_KEYS = ("source_documents", "sources", "context", "documents", "docs", "relevant_docs", "retrieved_docs")
+
+
+def _is_csv_path(path: str) -> bool:
+    # 末尾 4 文字だけを小文字化して比較（パス全体の lower() コピーを作らない）
+    return path[-4:].lower() == ".csv"
+
+def _scandir_recursive(root: str) -> Iterator[os.DirEntry]:
+    """Yield file entries under root using os.scandir (no extra stat per file).
+
+    Symlinks are skipped; unreadable directories are ignored.
+    """
+    try:
+        with os.scandir(root) as it:
+            for entry in it:
+                if entry.is_symlink():
+                    continue
+                if entry.is_file():
+                    yield entry
+                elif entry.is_dir():
+                    yield from _scandir_recursive(entry.path)
+    except (PermissionError, FileNotFoundError, NotADirectoryError):
+        pass
+
+
+_MADV_SEQUENTIAL = getattr(mmap, "MADV_SEQUENTIAL", None)
+
+
+def _file_may_contain(path: str, pattern: "re.Pattern[bytes]") -> bool:
+    """Scan the raw bytes of path via mmap. Errors count as a possible hit."""
+    try:
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            # 先頭から一度だけ読み切るので、OS に先読みを促す（Windows には無い）
+            if _MADV_SEQUENTIAL is not None:
+                mm.madvise(_MADV_SEQUENTIAL)
+            return pattern.search(mm) is not None
+    except (OSError, ValueError):
+        return True
+
+
+# 重い依存（LangChain のローダー群 / pandas）は実際に使う時まで import しない
+
+@functools.cache
+def _get_loader(ext: str) -> Optional[Any]:
+    """Return the loader constructor for ext, or None if unsupported (memoized)."""
+    supported = getattr(ct, "SUPPORTED_EXTENSIONS", None)
+    if supported is None:
+        from langchain_community.document_loaders import PyMuPDFLoader, Docx2txtLoader, TextLoader
+        from langchain_community.document_loaders.csv_loader import CSVLoader
+        supported = {
+            ".pdf": PyMuPDFLoader,
+            ".docx": Docx2txtLoader,
+            ".txt": lambda p: TextLoader(p, encoding="utf-8"),
+            ".csv": lambda p: CSVLoader(p, encoding="utf-8"),
+        }
+    return supported.get(ext)
+
+
+@functools.cache
+def _get_pandas() -> Optional[Any]:
+    """Import pandas on first use; None when it is not installed."""
+    try:
+        import pandas as pd  # type: ignore
+    except Exception:
+        return None
+    return pd
+
+
+# Streamlit は操作のたびにスクリプト全体を再実行するため、data/ の走査やファイルの
+# 読み込み結果は (パス, mtime) をキーにキャッシュし、変更があった時だけ読み直す。
+
+@st.cache_data(show_spinner=False, max_entries=256, ttl=600)
+def _list_data_files(data_root: str, root_mtime: float) -> Tuple[str, ...]:
+    """List file paths under data_root. root_mtime is only part of the cache key."""
+    return tuple(e.path for e in _scandir_recursive(data_root))
+
+
+def _data_root_files() -> Tuple[str, ...]:
+    data_root = getattr(ct, "RAG_TOP_FOLDER_PATH", "./data")
+    try:
+        root_mtime = os.stat(data_root).st_mtime
+    except OSError:
+        return ()
+    return _list_data_files(data_root, root_mtime)
+
+
+def _read_csv(path: str):
+    """Cached CSV read as (df, dept_cols); reused until the file's mtime or size changes."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None, []
+    return _load_csv_cached(path, stat.st_mtime, stat.st_size)
+
+
+@st.cache_data(show_spinner=False, max_entries=256, ttl=3600)
+def _load_csv_cached(path: str, mtime: float, size: int):
+    """Read a CSV into an all-str DataFrame (no type inference / NaN handling).
+
+    Returns (df, dept_cols) with the department-like column names, or (None, []) on failure.
+    """
+    pd = _get_pandas()
+    if pd is None:
+        return None, []
+    for enc in _csv_encodings(path):
+        try:
+            df = pd.read_csv(path, encoding=enc, dtype=str, engine="c", keep_default_na=False)
+        except Exception:
+            continue
+        return df, [c for c in df.columns if any(k in str(c) for k in _DEPT_COL_TOKENS)]
+    return None, []
+
+
+_CSV_ENCODINGS = ("utf-8", "utf-8-sig", "cp932")
+
+
+def _sniff_encoding(path: str, sample_size: int = 65536) -> Optional[str]:
+    """Guess the encoding of a CSV from its first bytes (BOM, then utf-8 / cp932 decode)."""
+    try:
+        with open(path, "rb") as f:
+            sample = f.read(sample_size)
+    except OSError:
+        return None
+    if sample.startswith(codecs.BOM_UTF8):
+        return "utf-8-sig"
+    for enc in ("utf-8", "cp932"):
+        try:
+            # final=False: サンプル末尾で途切れたマルチバイト文字はエラーにしない
+            codecs.getincrementaldecoder(enc)().decode(sample, final=False)
+            return enc
+        except UnicodeDecodeError:
+            continue
+    return None
+
+
+def _csv_encodings(path: str) -> Tuple[str, ...]:
+    """Encodings to try for path: the sniffed one first, then the remaining candidates."""
+    sniffed = _sniff_encoding(path)
+    if sniffed is None:
+        return _CSV_ENCODINGS
+    return (sniffed,) + tuple(e for e in _CSV_ENCODINGS if e != sniffed)
+
+
+@st.cache_data(show_spinner=False, max_entries=256)
+def _load_doc_cached(path: str, mtime: float, ext: str) -> List[Dict[str, Any]]:
+    """Load a document with the loader for ext, as plain dicts (page_content + metadata).
+
+    Plain dicts keep the cached value picklable. Load failures yield an empty list.
+    """
+    loader_ctor = _get_loader(ext)
+    if loader_ctor is None:
+        return []
+    pages: List[Dict[str, Any]] = []
+    try:
+        loader = loader_ctor(path)
+        # lazy_load はページ単位で生成するため、Document を全ページ分同時に保持しない
+        for d in getattr(loader, "lazy_load", loader.load)():
+            pages.append({
+                "page_content": str(getattr(d, "page_content", "")),
+                "metadata": dict(getattr(d, "metadata", {}) or {}),
+            })
+    except Exception:
+        return []
+    return pages
+
+
 def _extract_answer_and_sources(resp: Any) -> Tuple[str, List[Dict[str, Any]]]:
     """
     レスポンスから回答テキストと参照ドキュメント情報を抽出する。
@@ -511,107 +742,97 @@ def _extract_answer_and_sources(resp: Any) -> Tuple[str, List[Dict[str, Any]]]:
     各ドキュメントの metadata から以下を優先的に読む:
       source|file_path|path|url, page_number|page
     """
-    # 回答テキスト
-    text: str = (
-        getattr(resp, "answer", None)
-        or getattr(resp, "content", None)
-        or getattr(resp, "text", None)
-        or getattr(resp, "output_text", None)
-        or getattr(resp, "result", None)
-        or getattr(resp, "message", None)
-        or getattr(resp, "response", None)
-        or (resp.get("answer") if isinstance(resp, dict) else None)
-        or (resp.get("content") if isinstance(resp, dict) else None)
-        or (resp.get("text") if isinstance(resp, dict) else None)
-        or (resp.get("output_text") if isinstance(resp, dict) else None)
-        or (resp.get("result") if isinstance(resp, dict) else None)
-        or (resp.get("message") if isinstance(resp, dict) else None)
-        or (resp.get("response") if isinstance(resp, dict) else None)
-        or str(resp)
-    )
+    is_dict = isinstance(resp, dict)
+    # 回答テキスト（最初に見つかったキー／属性を採用。空文字の回答もそのまま返す）
+    text: Any = None
+    if is_dict:
+        for k in _TEXT_KEYS:
+            v = resp.get(k)
+            if v is not None:
+                text = v
+                break
+    else:
+        for k in _TEXT_KEYS:
+            v = getattr(resp, k, None)
+            if v is not None:
+                text = v
+                break
+    if text is None:
+        text = str(resp)
 
-    # ソース候補の収集
-    raw_sources: List[Any] = []
+    # ソース候補の収集（コピーせず、各シーケンスを遅延連結して走査する）
+    seqs: List[Iterable] = []
     # 属性から
-    if hasattr(resp, "source_documents"):
-        try:
-            raw = getattr(resp, "source_documents")
-            if isinstance(raw, Iterable):
-                raw_sources.extend(list(raw))
-        except Exception:
-            pass
+    raw = getattr(resp, "source_documents", None)
+    if isinstance(raw, Iterable):
+        seqs.append(raw)
     # dict キーから
-    if isinstance(resp, dict):
-        for key in ("source_documents", "sources", "context", "documents", "docs", "relevant_docs", "retrieved_docs"):
-            if key in resp and isinstance(resp[key], Iterable) and not isinstance(resp[key], (str, bytes)):
-                try:
-                    raw_sources.extend(list(resp[key]))
-                except Exception:
-                    pass
-
-    # Document/辞書から正規化
-    normalized: List[Dict[str, Any]] = []
-    for item in raw_sources:
-        src = None
-        page: Optional[int] = None
-        meta = None
-        content: Optional[str] = None
-
-        # LangChain Document 風: .metadata
-        if hasattr(item, "metadata"):
-            try:
-                meta = getattr(item, "metadata")
-            except Exception:
-                meta = None
-        # dict 風
-        if meta is None and isinstance(item, dict):
-            meta = item.get("metadata", item)
-
-        if isinstance(meta, dict):
-            src = (
-                meta.get("source")
-                or meta.get("file_path")
-                or meta.get("path")
-                or meta.get("url")
-            )
-            page = _extract_page_from_meta(meta)
+    if is_dict:
+        for key in _SRC_KEYS:
+            v = resp.get(key)
+            if isinstance(v, Iterable) and not isinstance(v, (str, bytes)):
+                seqs.append(v)
 
-        # src が本文に直接含まれている場合（保険）
-        if src is None and isinstance(item, dict):
-            src = item.get("source") or item.get("url") or item.get("path")
-            if page is None:
-                page = _extract_page_from_meta(item)
+    # Top-K（定数があれば）に達した時点で打ち切る
+    try:
+        k: Optional[int] = int(getattr(ct, "RETRIEVAL_TOP_K"))
+    except Exception:
+        k = None
 
-        # 抜粋用の本文テキスト
-        try:
-            if hasattr(item, "page_content"):
-                content = getattr(item, "page_content")
-            elif isinstance(item, dict):
-                content = item.get("page_content") or item.get("content") or item.get("text")
-        except Exception:
-            content = None
-
-        if src:
-            snippet = _make_snippet(content)
-            normalized.append({"source": src, "page": page, "snippet": snippet})
-
-    # 重複排除
-    dedup: List[Dict[str, Any]] = []
-    seen = set()
-    for s in normalized:
-        key = (s["source"], s.get("page"))
-        if key not in seen:
-            seen.add(key)
-            dedup.append(s)
-
-    # Top-Kで丸め（定数があれば）
+    # Document/辞書から正規化（同じ (source, page) は最初の 1 件のみ残す）
+    # dict は挿入順を保持するため、キー集合と結果リストを 1 つで兼ねる
+    unique: Dict[Tuple[Any, Optional[int]], Dict[str, Any]] = {}
+    for item in itertools.chain.from_iterable(_safe_iter(seq) for seq in seqs):
+        if k is not None and len(unique) >= k:
+            break
+        src, page, content = _normalize_source(item)
+        if not src or (src, page) in unique:
+            continue
+        unique[(src, page)] = {"source": src, "page": page, "snippet": _make_snippet(content)}
+
+    return text, list(unique.values())
+
+
+def _safe_iter(seq: Iterable) -> Iterator[Any]:
+    """Iterate seq, stopping quietly if iteration raises (e.g. an exhausted or broken generator)."""
     try:
-        k = int(getattr(ct, "RETRIEVAL_TOP_K", len(dedup)))
-        dedup = dedup[:k]
+        yield from seq
     except Exception:
-        pass
+        return
+
+
+def _normalize_source(item: Any) -> Tuple[Any, Optional[int], Optional[str]]:
+    """Return (source, page, page_content) for a Document-like or dict source item."""
+    src = None
+    page: Optional[int] = None
+
+    # LangChain Document 風: .metadata
+    meta = getattr(item, "metadata", None)
+    # dict 風
+    if meta is None and isinstance(item, dict):
+        meta = item.get("metadata", item)
 
-    return text, dedup
+    if isinstance(meta, dict):
+        src = (
+            meta.get("source")
+            or meta.get("file_path")
+            or meta.get("path")
+            or meta.get("url")
+        )
+        page = _extract_page_from_meta(meta)
+
+    # src が本文に直接含まれている場合（保険）
+    if src is None and isinstance(item, dict):
+        src = item.get("source") or item.get("url") or item.get("path")
+        if page is None:
+            page = _extract_page_from_meta(item)
+
+    # 抜粋用の本文テキスト
+    content: Optional[str] = getattr(item, "page_content", None)
+    if content is None and isinstance(item, dict):
+        content = item.get("page_content") or item.get("content") or item.get("text")
+
+    return src, page, content
 
 
 def _extract_page_from_meta(meta: Dict[str, Any]) -> Optional[int]:
@@ -662,7 +883,7 @@ def _render_sources(sources: List[Dict[str, Any]]) -> None:
         snippet = s.get("snippet")
         if not src:
             continue
-        is_link = isinstance(src, str) and src.startswith(("http://", "https://"))
+        is_link = isinstance(src, str) and src.startswith(ct.URL_PREFIXES)
         icon = ct.LINK_SOURCE_ICON if is_link else ct.DOC_SOURCE_ICON
         # 0 始まりのページ番号に対処（0 の時だけ 1 として表示）
         if isinstance(page, int) and page == 0:
@@ -681,21 +902,30 @@ def _render_sources(sources: List[Dict[str, Any]]) -> None:
                 )
 
 
+_LEADING_WS_RE = re.compile(r"\s*")
+
+
 def _make_snippet(text: Optional[str], limit: int = 280) -> Optional[str]:
     if not text:
         return None
-    t = str(text).strip()
-    if len(t) <= limit:
-        return t
-    return t[: limit - 1] + "…"
+    t = str(text)
+    # 本文全体を strip せず、先頭 limit 文字付近だけを見る（結果は strip 後に切り詰めた場合と同じ）
+    start = _LEADING_WS_RE.match(t).end()
+    head = t[start:start + limit + 1]
+    if len(head) > limit and (not head[limit].isspace() or t[start + limit:].strip()):
+        return head[: limit - 1] + "…"
+    return head.rstrip()
 
 
 def _last_user_prompt() -> str:
+    # main.py がユーザー発言の追加時に書き込む（O(1)）。未設定の場合のみ履歴を遡る
+    last = st.session_state.get("last_user_prompt")
+    if isinstance(last, str):
+        return last
     try:
-        msgs = st.session_state.get("messages", [])
-        for msg in reversed(msgs):
-            if msg.get("role") == "user":
-                return str(msg.get("content", ""))
+        turns = st.session_state.get("turns", [])
+        if turns:
+            return str(turns[-1]["user"])
     except Exception:
         pass
     return ""
@@ -708,26 +938,44 @@ def _looks_like_dept_listing_request(prompt: str, dept_name: str) -> bool:
     if dept_name not in p:
         return False
     # 「一覧」「リスト」「列挙」などの語と、社員/従業員などの語が含まれるかを簡易チェック
-    want_list = any(k in p for k in ["一覧", "リスト", "列挙", "まとめ", "一覧化"])
-    employee_word = any(k in p for k in ["従業員", "社員", "メンバー", "人物", "人員"])
-    return want_list and employee_word
+    intents = _detect_intents(p)
+    return "list" in intents and "emp" in intents
+
+
+_ENV_KEYWORDS = (
+    "環境への取り組み",
+    "環境",
+    "サステナビリティ",
+    "ESG",
+    "脱炭素",
+    "カーボンニュートラル",
+    "環境方針",
+    "ISO14001",
+)
+_INTENT_KEYWORDS = {
+    "env": _ENV_KEYWORDS,
+    "list": ("一覧", "リスト", "列挙", "まとめ", "一覧化"),
+    "emp": ("従業員", "社員", "メンバー", "人物", "人員"),
+}
+# 全意図のキーワードを名前付きグループで 1 つの正規表現にまとめ、プロンプトを 1 回だけ走査する
+_INTENT_RE = re.compile(
+    "|".join(
+        f"(?P<{name}>" + "|".join(map(re.escape, keywords)) + ")"
+        for name, keywords in _INTENT_KEYWORDS.items()
+    )
+)
+
+
+@functools.lru_cache(maxsize=64)
+def _detect_intents(prompt: str) -> frozenset:
+    """Names of the _INTENT_KEYWORDS groups that occur in prompt."""
+    return frozenset(m.lastgroup for m in _INTENT_RE.finditer(prompt))
 
 
 def _looks_like_environment_request(prompt: str) -> bool:
     if not isinstance(prompt, str) or not prompt:
         return False
-    keywords = [
-        "環境への取り組み",
-        "環境",
-        "サステナビリティ",
-        "ESG",
-        "脱炭素",
-        "カーボンニュートラル",
-        "環境方針",
-        "ISO14001",
-    ]
-    p = prompt
-    return any(k in p for k in keywords)
+    return "env" in _detect_intents(prompt)
 
 
 def _looks_unrelated_to_corp_docs(prompt: str, sources: List[Dict[str, Any]]) -> bool:
@@ -805,7 +1053,7 @@ def _try_render_department_listing(sources: List[Dict[str, Any]], dept_name: str
     csv_paths: List[str] = []
     for s in sources:
         src = s.get("source")
-        if isinstance(src, str) and src.lower().endswith(".csv"):
+        if isinstance(src, str) and _is_csv_path(src):
             # デプロイ環境では絶対パスが無効な場合があるため、ローカル data 配下を探索
             resolved = _resolve_local_data_path(src)
             if resolved:
@@ -817,47 +1065,28 @@ def _try_render_department_listing(sources: List[Dict[str, Any]], dept_name: str
         return False
 
     # pandas は遅延 import（無い環境でも UI は壊さない）。無ければ csv モジュールで代替。
-    try:
-        import pandas as pd  # type: ignore
-    except Exception:
-        pd = None  # type: ignore
+    pd = _get_pandas()
 
     for path in csv_paths:
         if pd is not None:
-            # pandas あり
-            try:
-                df = pd.read_csv(path, encoding="utf-8")
-            except Exception:
-                # 一部 CSV は BOM 付きなどのためリトライ
-                try:
-                    df = pd.read_csv(path, encoding="utf-8-sig")
-                except Exception:
-                    try:
-                        df = pd.read_csv(path, encoding="cp932")
-                    except Exception:
-                        df = None
+            # pandas あり（BOM 付き・cp932 の CSV もあるためエンコーディングを順に試す）
+            # 部署っぽいカラムは読み込み時に推測済み
+            df, dept_cols = _read_csv(path)
 
             if df is None or df.empty:
                 continue
 
-            # 部署っぽいカラムを推測
-            cols = [str(c) for c in df.columns]
-            dept_cols = [c for c in cols if any(k in c for k in ["部署", "部門", "所属", "部"]) ]
             if not dept_cols:
                 # カラム名が読めない場合、全文検索的に行フィルタ
-                mask = df.apply(lambda row: row.astype(str).str.contains(dept_name, na=False).any(), axis=1)
+                mask = _mask_contains_in_columns(df, df.columns, dept_name)
                 sub = df.loc[mask]
             else:
                 # いずれかの部署カラムが dept_name と一致する行を抽出
-                mask = False
-                for c in dept_cols:
-                    mask = mask | (df[c].astype(str) == dept_name)
+                mask = _mask_by_dept(df, dept_cols, dept_name)
                 sub = df.loc[mask]
                 # 一致で足りなければ包含検索にフォールバック
                 if sub is None or len(sub) < min_rows:
-                    mask2 = False
-                    for c in dept_cols:
-                        mask2 = mask2 | (df[c].astype(str).str.contains(dept_name, na=False))
+                    mask2 = _mask_contains_in_columns(df, dept_cols, dept_name)
                     sub = df.loc[mask2]
 
             if sub is None or sub.empty:
@@ -868,14 +1097,14 @@ def _try_render_department_listing(sources: List[Dict[str, Any]], dept_name: str
                 continue
 
             st.markdown(f"### {dept_name} の従業員一覧")
-            st.dataframe(sub, use_container_width=True)
+            st.dataframe(_listing_frame(sub), use_container_width=True, hide_index=True)
             return True
         else:
             # pandas なし: csv モジュールで読み込み
             import csv
             rows: List[dict] = []
             read_ok = False
-            for enc in ("utf-8", "utf-8-sig", "cp932"):
+            for enc in _csv_encodings(path):
                 try:
                     with open(path, "r", encoding=enc, newline="") as f:
                         reader = csv.DictReader(f)
@@ -889,7 +1118,7 @@ def _try_render_department_listing(sources: List[Dict[str, Any]], dept_name: str
 
             # 列名を収集
             cols = list(rows[0].keys()) if rows else []
-            dept_cols = [c for c in cols if any(k in c for k in ["部署", "部門", "所属", "部"]) ]
+            dept_cols = _dept_columns(cols)
 
             def row_matches(r: dict) -> bool:
                 if dept_cols:
@@ -911,20 +1140,72 @@ def _try_render_department_listing(sources: List[Dict[str, Any]], dept_name: str
 
             st.markdown(f"### {dept_name} の従業員一覧")
             # Markdown テーブルで描画（pandas 依存を避ける）
-            cols = list({k for r in sub_rows for k in r.keys()})
-            if cols:
-                header = "| " + " | ".join(cols) + " |"
-                sep = "|" + "|".join([" --- "] * len(cols)) + "|"
-                st.markdown(header)
-                st.markdown(sep)
-                for r in sub_rows:
-                    row = [str(r.get(c, "")) for c in cols]
-                    st.markdown("| " + " | ".join(row) + " |")
+            _render_markdown_table(sub_rows)
             return True
 
     return False
 
 
+def _render_markdown_table(rows: List[dict]) -> None:
+    """Render rows as one Markdown table in a single st.markdown call (column order kept)."""
+    cols = list(dict.fromkeys(k for r in rows for k in r.keys()))
+    if not cols:
+        return
+    lines = [
+        "| " + " | ".join(cols) + " |",
+        "|" + "|".join([" --- "] * len(cols)) + "|",
+    ]
+    lines.extend("| " + " | ".join(str(r.get(c, "")) for c in cols) + " |" for r in rows)
+    st.markdown("\n".join(lines))
+
+
+# 一覧表示に使う列名の部分文字列（実データ例: 社員ID / 氏名（フルネーム） / メールアドレス / 部署 / 役職）
+_LISTING_COL_TOKENS = ("氏名", "名前", "社員番号", "部署", "部門", "所属", "役職", "メール", "内線")
+
+
+def _listing_columns(cols: Iterable[Any]) -> List[Any]:
+    """Columns to show in a department listing, in CSV order.
+
+    Picks ID / name / department / title / mail-like columns by substring; when fewer than two
+    match the roster is not recognized and all columns are kept.
+    """
+    cols = list(cols)
+    keep = [
+        c for c in cols
+        if str(c).endswith("ID") or any(k in str(c) for k in _LISTING_COL_TOKENS)
+    ]
+    return keep if len(keep) >= 2 else cols
+
+
+def _listing_frame(sub):
+    """Project a roster DataFrame to the listing columns, with object columns as pandas "string"."""
+    keep = _listing_columns(sub.columns)
+    out = sub[keep]
+    obj_cols = [c for c in keep if out[c].dtype == object]
+    if obj_cols:
+        out = out.astype(dict.fromkeys(obj_cols, "string"))
+    return out
+
+
+def _mask_by_dept(df, dept_cols, dept_name: str):
+    """Row mask: True where any of dept_cols equals dept_name."""
+    import numpy as np
+
+    # 全列 str で読み込んでいるため astype(str) は不要。object 配列同士の比較で済ませる
+    return np.logical_or.reduce([df[c].to_numpy(dtype=object) == dept_name for c in dept_cols])
+
+
+def _mask_contains_in_columns(df, columns, needle: str):
+    """Row mask: True where any of columns contains needle (column-wise, vectorized)."""
+    import numpy as np  # pandas の依存なので DataFrame があれば必ず import できる
+
+    # Series 同士の | はインデックス整列を伴うため、numpy の bool 配列に直接 OR する
+    mask = np.zeros(len(df), dtype=bool)
+    for c in columns:
+        mask |= df[c].astype(str).str.contains(needle, na=False, regex=False).to_numpy(dtype=bool)
+    return mask
+
+
 def _resolve_local_data_path(path: str) -> Optional[str]:
     try:
         # 既に存在する
@@ -932,12 +1213,9 @@ def _resolve_local_data_path(path: str) -> Optional[str]:
             return path
         # ファイル名で data/ 以下を探索
         base = os.path.basename(path)
-        data_root = getattr(ct, "RAG_TOP_FOLDER_PATH", "./data")
-        pattern = os.path.join(data_root, "**", base)
-        matches = glob.glob(pattern, recursive=True)
-        for m in matches:
-            if os.path.isfile(m):
-                return m
+        for p in _data_root_files():
+            if os.path.basename(p) == base:
+                return p
     except Exception:
         return None
     return None
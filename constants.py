@@ -2,15 +2,14 @@
 簡易版の定数ファイル。実行時の参照を満たすために必要な定数を定義します。
 本番用には元の定義を反映してください。
 """
-from langchain_community.document_loaders import PyMuPDFLoader, Docx2txtLoader, TextLoader
-from langchain_community.document_loaders.csv_loader import CSVLoader
-
 APP_NAME = "社内情報特化型生成AI検索アプリ"
 ANSWER_MODE_1 = "社内文書検索"
 ANSWER_MODE_2 = "社内問い合わせ"
 CHAT_INPUT_HELPER_TEXT = "こちらからメッセージを送信してください。"
 DOC_SOURCE_ICON = ":material/description: "
 LINK_SOURCE_ICON = ":material/link: "
+# Sources starting with these are shown with LINK_SOURCE_ICON
+URL_PREFIXES = ("http://", "https://", "HTTP://", "HTTPS://")
 WARNING_ICON = ":material/warning:"
 ERROR_ICON = ":material/error:"
 SPINNER_TEXT = "回答生成中..."
@@ -24,28 +23,79 @@ MODEL = "gpt-4o-mini"
 TEMPERATURE = 0.5
 
 RAG_TOP_FOLDER_PATH = "./data"
+
+
+# Loader factories import LangChain loaders (pymupdf, docx2txt, ...) on first use only.
+def _pdf_loader(path):
+    from langchain_community.document_loaders import PyMuPDFLoader
+    return PyMuPDFLoader(path)
+
+
+def _docx_loader(path):
+    from langchain_community.document_loaders import Docx2txtLoader
+    return Docx2txtLoader(path)
+
+
+def _csv_loader(path):
+    from langchain_community.document_loaders.csv_loader import CSVLoader
+    return CSVLoader(path, encoding="utf-8")
+
+
+def _txt_loader(path):
+    from langchain_community.document_loaders import TextLoader
+    return TextLoader(path, encoding="utf-8")
+
+
 SUPPORTED_EXTENSIONS = {
-    ".pdf": PyMuPDFLoader,
-    ".docx": Docx2txtLoader,
-    ".csv": lambda path: CSVLoader(path, encoding="utf-8"),
-    ".txt": lambda path: TextLoader(path, encoding="utf-8")
+    ".pdf": _pdf_loader,
+    ".docx": _docx_loader,
+    ".csv": _csv_loader,
+    ".txt": _txt_loader,
 }
 WEB_URL_LOAD_TARGETS = [
     "https://generative-ai.web-camp.io/"
 ]
+# Upper bound of threads used to load files / URLs at startup
+LOAD_MAX_WORKERS = 32
 
 RETRIEVAL_TOP_K = 5
+# Minimum relevance score (0-1, higher is closer) of retrieved chunks; None keeps all top-k.
+# When nothing passes, the fixed no-match answer is returned without calling the LLM.
+MIN_SIMILARITY = None
 CHUNK_SIZE = 500
 CHUNK_OVERLAP = 50
 
+# On-disk vector index: only chunks not yet stored are embedded on startup
+PERSIST_DIR = "./.chroma"
+CHROMA_COLLECTION_NAME = "company_docs"
+CHROMA_ADD_BATCH_SIZE = 1000
+# Chunk embeddings cached by content hash, so duplicated chunks are embedded once
+EMBEDDING_CACHE_PATH = "./.chroma/embedding_cache.sqlite3"
+EMBED_BATCH_SIZE = 512
+
+# Past turns (user + assistant message pairs) sent to the prompts with each question
+MAX_HISTORY_TURNS = 8
+
+# Answers reused for the same (mode, normalized question, chat history); not used with USE_AGENT
+RESPONSE_CACHE_TTL = 3600
+RESPONSE_CACHE_MAX_ENTRIES = 512
+
 # If True, call LLM even when the input seems unrelated to corporate documents.
 # If False, show fixed messages without calling LLM for such inputs.
 ALLOW_OFFTOPIC_LLM = True
 
+# Fallbacks tried in order when the LLM call fails (see components.handle_llm_error).
+# "offtopic": fixed message for unrelated input / "dept_listing": roster CSV search on quota errors
+# "keyword_search": naive keyword search over data/ on quota errors
+LLM_ERROR_FALLBACKS = ("offtopic", "dept_listing", "keyword_search")
+
 # Optional agent settings (disabled by default)
 USE_AGENT = False
 MAX_AGENT_ITERATIONS = 3
 AGENT_EARLY_STOP_METHOD = "generate"
+# Token budget of the agent's search tool output (per document / whole output)
+AGENT_TOOL_DOC_TOKENS = 300
+AGENT_TOOL_TOTAL_TOKENS = 1200
 
 SYSTEM_PROMPT_CREATE_INDEPENDENT_TEXT = "会話履歴と最新の入力をもとに、会話履歴なしでも理解できる独立した入力テキストを生成してください。"
 SYSTEM_PROMPT_DOC_SEARCH = """
@@ -7,26 +7,46 @@ from __future__ import annotations
 
 import os
 import sys
+import functools
+import hashlib
+import json
 import logging
+import sqlite3
+import threading
 import unicodedata
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from typing import TYPE_CHECKING
 from uuid import uuid4
 from logging.handlers import TimedRotatingFileHandler
 
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 from dotenv import load_dotenv
 from langchain_community.document_loaders import WebBaseLoader
-from langchain.text_splitter import CharacterTextSplitter
-from langchain_openai import OpenAIEmbeddings
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
 from langchain_community.vectorstores import Chroma
 
 import constants as ct
 
+if TYPE_CHECKING:
+    from langchain_openai import OpenAIEmbeddings
 
-# Load .env early
-load_dotenv()
+
+_IS_WIN = sys.platform.startswith("win")
+
+
+@st.cache_resource(show_spinner=False)
+def _load_env() -> bool:
+    """Load .env once per process (also across module reloads)."""
+    load_dotenv()
+    return True
 
 
 def _ensure_openai_key() -> None:
+    _load_env()
     try:
         if not os.getenv("OPENAI_API_KEY"):
             key = None
@@ -64,10 +84,9 @@ def _initialize_logger() -> None:
 
 
 def _ensure_session_state() -> None:
-    if "messages" not in st.session_state:
-        st.session_state.messages = []
-    if "chat_history" not in st.session_state:
-        st.session_state.chat_history = []
+    if "turns" not in st.session_state:
+        # Conversation log and LLM history in one list (see components.Turn)
+        st.session_state.turns = []
     if "session_id" not in st.session_state:
         st.session_state.session_id = uuid4().hex
 
@@ -78,50 +97,16 @@ def _initialize_retriever() -> None:
         return
 
     try:
-        docs_all = _load_data_sources()
-
-        # Ingestion diagnostics: count PDFs and non-empty contents
-        try:
-            pdf_docs = [d for d in docs_all if str(d.metadata.get("source", "")).lower().endswith(".pdf")]
-            pdf_nonempty = [d for d in pdf_docs if isinstance(d.page_content, str) and d.page_content.strip()]
-            empty_examples = [str(d.metadata.get("source", "")) for d in pdf_docs if not (isinstance(d.page_content, str) and d.page_content.strip())][:5]
-            st.session_state["ingest_stats"] = {
-                "total_docs": len(docs_all),
-                "pdf_count": len(pdf_docs),
-                "pdf_nonempty_count": len(pdf_nonempty),
-                "pdf_empty_examples": empty_examples,
-            }
-        except Exception:
-            # Non-fatal
-            pass
-
-        # Normalize text on Windows hosts (defensive)
-        if sys.platform.startswith("win"):
-            for doc in docs_all:
-                doc.page_content = _adjust_string(doc.page_content)
-                for key in list(doc.metadata.keys()):
-                    doc.metadata[key] = _adjust_string(doc.metadata[key])
-
-        # If API key missing, avoid initializing embeddings and run without retriever
-        if not os.getenv("OPENAI_API_KEY"):
+        has_api_key = bool(os.getenv("OPENAI_API_KEY"))
+        retriever, ingest_stats = _build_retriever(_data_root_signature(), has_api_key)
+        if ingest_stats is not None:
+            st.session_state["ingest_stats"] = ingest_stats
+        # If API key missing, embeddings were not initialized; run without retriever
+        if not has_api_key:
             logging.getLogger(ct.LOGGER_NAME).warning(
                 "OPENAI_API_KEY not found. Starting without retriever (LLM-only mode)."
             )
-            st.session_state.retriever = None
-            return
-
-        embeddings = OpenAIEmbeddings()
-        splitter = CharacterTextSplitter(
-            chunk_size=int(getattr(ct, "CHUNK_SIZE", 500)),
-            chunk_overlap=int(getattr(ct, "CHUNK_OVERLAP", 50)),
-            separator="\n",
-        )
-        splitted_docs = splitter.split_documents(docs_all)
-
-        db = Chroma.from_documents(splitted_docs, embedding=embeddings)
-        st.session_state.retriever = db.as_retriever(
-            search_kwargs={"k": int(getattr(ct, "RETRIEVAL_TOP_K", 5))}
-        )
+        st.session_state.retriever = retriever
     except Exception as e:
         logging.getLogger(ct.LOGGER_NAME).warning(
             f"Retriever initialization failed; falling back to LLM-only mode. error={e}"
@@ -129,54 +114,385 @@ def _initialize_retriever() -> None:
         st.session_state.retriever = None
 
 
-def _load_data_sources():
-    docs_all = []
-    _recursive_file_check(getattr(ct, "RAG_TOP_FOLDER_PATH", "./data"), docs_all)
-
-    # Optional: load from web
-    web_docs_all = []
-    for web_url in getattr(ct, "WEB_URL_LOAD_TARGETS", []):
+def _data_root_signature() -> tuple:
+    """(path, mtime, size) of every file under the data root; changes when any file changes."""
+    sig = []
+    for path in _iter_files(getattr(ct, "RAG_TOP_FOLDER_PATH", "./data")):
         try:
-            loader = WebBaseLoader(web_url)
-            web_docs = loader.load()
-            web_docs_all.extend(web_docs)
-        except Exception as e:
-            logging.getLogger(ct.LOGGER_NAME).warning(
-                f"WEB_URL_LOAD_TARGET skipped: {web_url} error={e}"
+            stat = os.stat(path)
+        except OSError:
+            continue
+        sig.append((path, stat.st_mtime, stat.st_size))
+    return tuple(sorted(sig))
+
+
+@st.cache_resource(show_spinner=False)
+def _get_embeddings() -> OpenAIEmbeddings:
+    # Imported here so langchain_openai is not loaded before the first render
+    from langchain_openai import OpenAIEmbeddings
+
+    # One embeddings client (and its HTTP connection pool) shared by all sessions
+    return OpenAIEmbeddings()
+
+
+@st.cache_resource(show_spinner=False)
+def _build_retriever(data_root_sig: tuple, has_api_key: bool):
+    """Load data sources and build the Chroma retriever, shared across sessions.
+
+    Keyed on the data root signature so edits under data/ trigger a rebuild.
+    Returns (retriever or None, ingest_stats or None).
+    """
+    docs_all = _load_data_sources()
+
+    # Ingestion diagnostics: count PDFs and non-empty contents
+    ingest_stats = None
+    try:
+        # Single pass over docs_all
+        pdf_count = pdf_nonempty = 0
+        empty_examples = []
+        for d in docs_all:
+            src = str(d.metadata.get("source", ""))
+            if not src.lower().endswith(".pdf"):
+                continue
+            pdf_count += 1
+            if isinstance(d.page_content, str) and d.page_content.strip():
+                pdf_nonempty += 1
+            elif len(empty_examples) < 5:
+                empty_examples.append(src)
+        ingest_stats = {
+            "total_docs": len(docs_all),
+            "pdf_count": pdf_count,
+            "pdf_nonempty_count": pdf_nonempty,
+            "pdf_empty_examples": empty_examples,
+        }
+    except Exception:
+        # Non-fatal
+        pass
+
+    # Normalize text on Windows hosts (defensive)
+    if _IS_WIN:
+        for doc in docs_all:
+            doc.page_content = _adjust_string(doc.page_content)
+            for key, value in list(doc.metadata.items()):
+                if isinstance(value, str):
+                    # Metadata values (source path, title, ...) repeat on every page
+                    doc.metadata[key] = _adjust_string_cached(value)
+
+    if not has_api_key:
+        return None, ingest_stats
+
+    embeddings = _get_embeddings()
+    splitted_docs = _split_documents(
+        docs_all,
+        int(getattr(ct, "CHUNK_SIZE", 500)),
+        int(getattr(ct, "CHUNK_OVERLAP", 50)),
+    )
+
+    db = _sync_vectorstore(splitted_docs, embeddings)
+    search_kwargs = {"k": int(getattr(ct, "RETRIEVAL_TOP_K", 5))}
+    min_similarity = getattr(ct, "MIN_SIMILARITY", None)
+    if min_similarity is None:
+        retriever = db.as_retriever(search_kwargs=search_kwargs)
+    else:
+        # Chunks scoring below the threshold are dropped (possibly leaving no documents)
+        search_kwargs["score_threshold"] = float(min_similarity)
+        retriever = db.as_retriever(
+            search_type="similarity_score_threshold", search_kwargs=search_kwargs
+        )
+    return retriever, ingest_stats
+
+
+def _split_documents(docs, chunk_size: int, chunk_overlap: int, separator: str = "\n") -> list:
+    """Split docs into chunks like CharacterTextSplitter(separator=separator).split_documents().
+
+    Uses the same merge rule as LangChain's splitter, so chunk boundaries (and the chunk ids
+    derived from them) do not change; the current chunk is tracked as a slice of parts.
+    """
+    sep_len = len(separator)
+    out = []
+    for doc in docs:
+        metadata = doc.metadata
+        parts = [p for p in doc.page_content.split(separator) if p]
+        start = 0  # the current chunk is parts[start:end]
+        total = 0
+        for end, part in enumerate(parts):
+            part_len = len(part)
+            if end > start and total + part_len + sep_len > chunk_size:
+                _append_chunk(out, separator.join(parts[start:end]), metadata)
+                # Drop leading parts until the kept tail fits in the overlap and the next part fits
+                while start < end and (
+                    total > chunk_overlap or total + part_len + sep_len > chunk_size
+                ):
+                    total -= len(parts[start]) + (sep_len if end - start > 1 else 0)
+                    start += 1
+            total += part_len + (sep_len if end > start else 0)
+        _append_chunk(out, separator.join(parts[start:]), metadata)
+    return out
+
+
+def _append_chunk(out: list, text: str, metadata: dict) -> None:
+    text = text.strip()
+    if text:
+        out.append(Document(page_content=text, metadata=dict(metadata)))
+
+
+def _chunk_ids(docs) -> list:
+    """Stable ids derived from metadata + content, so unchanged chunks keep their id across restarts.
+
+    The whole metadata dict (source, page, ...) is part of the id: a chunk that moved to another
+    page of an edited file gets a new id, and is re-added with its new metadata.
+    """
+    ids = []
+    occurrences = {}
+    for doc in docs:
+        meta = json.dumps(doc.metadata, sort_keys=True, ensure_ascii=False, default=str)
+        base = hashlib.sha1(
+            f"{meta}\0{doc.page_content}".encode("utf-8", "ignore")
+        ).hexdigest()
+        # Identical chunks with identical metadata still need distinct ids
+        n = occurrences.get(base, 0)
+        occurrences[base] = n + 1
+        ids.append(f"{base}-{n}")
+    return ids
+
+
+def _sync_vectorstore(splitted_docs, embeddings) -> Chroma:
+    """Open the on-disk Chroma index and embed only chunks it does not have yet.
+
+    Chunks whose source was edited or removed are deleted, so the index mirrors the current corpus.
+    """
+    db = Chroma(
+        collection_name=ct.CHROMA_COLLECTION_NAME,
+        persist_directory=ct.PERSIST_DIR,
+        embedding_function=_CachedEmbeddings(embeddings),
+    )
+    ids = _chunk_ids(splitted_docs)
+    existing = set(db.get(include=[])["ids"])
+
+    stale = list(existing.difference(ids))
+    if stale:
+        db.delete(ids=stale)
+
+    new_pairs = [(i, d) for i, d in zip(ids, splitted_docs) if i not in existing]
+    batch = int(getattr(ct, "CHROMA_ADD_BATCH_SIZE", 1000))
+    for start in range(0, len(new_pairs), batch):
+        part = new_pairs[start:start + batch]
+        db.add_documents([d for _, d in part], ids=[i for i, _ in part])
+    logging.getLogger(ct.LOGGER_NAME).info(
+        f"Vector index synced: total={len(ids)} added={len(new_pairs)} removed={len(stale)}"
+    )
+    _persist(db)
+    return db
+
+
+def _persist(db: Chroma) -> None:
+    """Flush the index to persist_directory on chromadb < 0.4 (pinned in requirements_mac.txt).
+
+    chromadb >= 0.4 writes automatically and has no client-side persist().
+    """
+    try:
+        import chromadb
+
+        major, minor = (int(x) for x in chromadb.__version__.split(".")[:2])
+    except Exception:
+        return
+    if (major, minor) < (0, 4):
+        db.persist()
+
+
+def _embed_with_cache(texts, embeddings) -> list:
+    """Embed texts, reusing vectors stored on disk by content hash.
+
+    Identical chunks (shared headers/footers, copies across files) are embedded once;
+    only unseen hashes are sent to the API, in EMBED_BATCH_SIZE batches.
+    """
+    if not texts:
+        return []
+    model = str(getattr(embeddings, "model", ""))
+    keys = [
+        hashlib.blake2b(f"{model}\0{t}".encode("utf-8", "ignore"), digest_size=16).hexdigest()
+        for t in texts
+    ]
+    text_by_key = dict(zip(keys, texts))
+    unique_keys = list(text_by_key)
+    vectors = {}
+
+    cache_path = ct.EMBEDDING_CACHE_PATH
+    os.makedirs(os.path.dirname(cache_path) or ".", exist_ok=True)
+    with closing(sqlite3.connect(cache_path)) as conn:
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)"
+        )
+        # Stay under SQLite's bound-parameter limit
+        for start in range(0, len(unique_keys), 500):
+            part = unique_keys[start:start + 500]
+            rows = conn.execute(
+                f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(part))})",
+                part,
             )
+            for key, blob in rows:
+                vectors[key] = array("d", blob).tolist()
+
+        missing = [k for k in unique_keys if k not in vectors]
+        batch = int(getattr(ct, "EMBED_BATCH_SIZE", 512))
+        for start in range(0, len(missing), batch):
+            part = missing[start:start + batch]
+            embedded = embeddings.embed_documents([text_by_key[k] for k in part])
+            vectors.update(zip(part, embedded))
+            with conn:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                    [(k, array("d", v).tobytes()) for k, v in zip(part, embedded)],
+                )
+
+    logging.getLogger(ct.LOGGER_NAME).info(
+        f"Embeddings: chunks={len(texts)} unique={len(unique_keys)} api={len(missing)}"
+    )
+    return [vectors[k] for k in keys]
 
-    docs_all.extend(web_docs_all)
+
+class _CachedEmbeddings(Embeddings):
+    """Embeddings for the Chroma index: document vectors go through the on-disk cache.
+
+    Chroma.add_documents() calls embed_documents(), so cached chunks are added through the
+    public API without an API call. Query embeddings are always computed.
+    """
+
+    def __init__(self, embeddings: Embeddings):
+        self._embeddings = embeddings
+
+    def embed_documents(self, texts):
+        return _embed_with_cache(list(texts), self._embeddings)
+
+    def embed_query(self, text):
+        return self._embeddings.embed_query(text)
+
+
+def _load_data_sources():
+    supported = getattr(ct, "SUPPORTED_EXTENSIONS", {})
+    paths = [
+        p for p in _iter_files(getattr(ct, "RAG_TOP_FOLDER_PATH", "./data"))
+        if os.path.splitext(p)[1] in supported
+    ]
+    web_urls = list(getattr(ct, "WEB_URL_LOAD_TARGETS", []))
+
+    # Files and URLs load independently, so fetch them on a thread pool.
+    # PyMuPDF is not thread-safe: PDFs are parsed on this thread while the pool runs.
+    workers = min(int(getattr(ct, "LOAD_MAX_WORKERS", 32)), (os.cpu_count() or 1) * 4)
+    with ThreadPoolExecutor(max_workers=max(1, workers), initializer=_attach_script_ctx()) as pool:
+        futures = {p: pool.submit(_file_load, p) for p in paths if not _is_pdf(p)}
+        web_futures = [pool.submit(_web_load, url) for url in web_urls]
+        pdf_docs = {p: _file_load(p) for p in paths if _is_pdf(p)}
+
+        # Keep the traversal order (files first, then web) as before
+        docs_all = []
+        for p in paths:
+            docs_all.extend(pdf_docs[p] if p in pdf_docs else futures[p].result())
+        for future in web_futures:
+            docs_all.extend(future.result())
     return docs_all
 
 
-def _recursive_file_check(path, docs_all) -> None:
-    if os.path.isdir(path):
-        for name in os.listdir(path):
-            full_path = os.path.join(path, name)
-            _recursive_file_check(full_path, docs_all)
-    else:
-        _file_load(path, docs_all)
+def _is_pdf(path) -> bool:
+    return os.path.splitext(path)[1] == ".pdf"
 
 
-def _file_load(path, docs_all) -> None:
+def _attach_script_ctx():
+    """Thread initializer giving pool workers the caller's ScriptRunContext.
+
+    st.cache_data used from worker threads (see _fetch_web) otherwise logs
+    "missing ScriptRunContext" warnings.
+    """
+    ctx = get_script_run_ctx()
+
+    def _init() -> None:
+        if ctx is not None:
+            add_script_run_ctx(threading.current_thread(), ctx)
+
+    return _init
+
+
+@st.cache_data(ttl=86400, show_spinner=False)
+def _fetch_web(web_url: str) -> list:
+    # Failures raise and are therefore not cached; the next rebuild retries
+    return WebBaseLoader(web_url).load()
+
+
+def _web_load(web_url) -> list:
+    try:
+        return _fetch_web(web_url)
+    except Exception as e:
+        logging.getLogger(ct.LOGGER_NAME).warning(
+            f"WEB_URL_LOAD_TARGET skipped: {web_url} error={e}"
+        )
+        return []
+
+
+def _iter_files(root):
+    """Yield file paths under root (or root itself if it is a file).
+
+    Uses os.scandir with an explicit stack: DirEntry caches the file type from the
+    directory listing, so no extra stat per entry and no recursion.
+    Symlinked directories are not followed.
+    """
+    stack = [root]
+    while stack:
+        path = stack.pop()
+        try:
+            it = os.scandir(path)
+        except NotADirectoryError:
+            yield path
+            continue
+        except OSError:
+            continue
+        with it as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                else:
+                    yield entry.path
+
+
+def _file_load(path) -> list:
     ext = os.path.splitext(path)[1]
     supported = getattr(ct, "SUPPORTED_EXTENSIONS", {})
-    if ext in supported:
-        try:
-            loader = supported[ext](path)
-            docs = loader.load()
-            docs_all.extend(docs)
-        except Exception as e:
-            logging.getLogger(ct.LOGGER_NAME).warning(
-                f"FILE_LOAD skipped: {path} error={e}"
-            )
+    if ext not in supported:
+        return []
+    try:
+        loader = supported[ext](path)
+        return loader.load()
+    except Exception as e:
+        logging.getLogger(ct.LOGGER_NAME).warning(
+            f"FILE_LOAD skipped: {path} error={e}"
+        )
+        return []
+
+
+# Characters cp932 can encode but decodes to a different code point. The
+# encode("cp932", "ignore").decode("cp932") round trip folds them, so the fast path must too.
+_CP932_FOLD = str.maketrans({
+    "\u00a2": "\uffe0",  # ¢ -> ￠
+    "\u00a3": "\uffe1",  # £ -> ￡
+    "\u00ac": "\uffe2",  # ¬ -> ￢
+    "\u2016": "\u2225",  # ‖ -> ∥
+    "\u2212": "\uff0d",  # − -> －
+    "\u301c": "\uff5e",  # 〜 -> ～
+})
 
 
 def _adjust_string(s):
     if not isinstance(s, str):
         return s
-    if sys.platform.startswith("win"):
-        s = unicodedata.normalize("NFC", s)
-        s = s.encode("cp932", "ignore").decode("cp932")
+    # ASCII is already NFC and cp932-safe; skip the normalize/encode round trip
+    if not _IS_WIN or s.isascii():
         return s
-    return s
\ No newline at end of file
+    s = unicodedata.normalize("NFC", s)
+    try:
+        # Common case: everything is representable in cp932; only fold the non-round-trip characters
+        s.encode("cp932")
+        return s.translate(_CP932_FOLD)
+    except UnicodeEncodeError:
+        return s.encode("cp932", "ignore").decode("cp932")
+
+
+_adjust_string_cached = functools.lru_cache(maxsize=8192)(_adjust_string)
\ No newline at end of file
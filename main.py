@@ -32,14 +32,19 @@ cp.display_conversation_log()
 # Input and response
 chat_message = st.chat_input("質問を入力してください…")
 if chat_message:
-    # Ensure message log exists
-    if "messages" not in st.session_state:
-        st.session_state.messages = []
+    # Ensure conversation log exists
+    if "turns" not in st.session_state:
+        st.session_state.turns = []
 
     with st.chat_message("user"):
         st.markdown(chat_message)
-    # Append to conversation log (for components' fallback detection)
-    st.session_state.messages.append({"role": "user", "content": chat_message})
+    # Append to conversation log (for components' fallback detection); answered below
+    turn = {"user": chat_message, "assistant": None, "answer": None}
+    st.session_state.turns.append(turn)
+    st.session_state["last_user_prompt"] = chat_message
+
+    # Assistant bubble: streamed answer text first, replaced by the final rendering below
+    answer_slot = st.empty()
 
     # Off-topic guard: skip LLM/retriever calls and show fixed message per mode
     try:
@@ -48,67 +53,29 @@ if chat_message:
             and hasattr(cp, "_looks_unrelated_to_corp_docs")
             and cp._looks_unrelated_to_corp_docs(chat_message, [])
         ):
-            if mode == ct.ANSWER_MODE_1:
-                fixed = "入力内容と関連する社内文書が見つかりませんでした"
-            else:
-                fixed = getattr(ct, "INQUIRY_NO_MATCH_ANSWER", "回答に必要な情報が見つかりませんでした。")
+            fixed = cp.offtopic_message(mode)
             with st.chat_message("assistant"):
                 st.warning(fixed)
-            try:
-                st.session_state.messages.append({"role": "assistant", "content": fixed})
-            except Exception:
-                pass
+            turn["assistant"] = fixed
             st.stop()
 
-        # Normal LLM flow
-        llm_resp = utils.get_llm_response(chat_message)
+        # Normal LLM flow (tokens are shown as they arrive)
+        llm_resp = {}
+        with answer_slot.container(), st.chat_message("assistant"):
+            st.write_stream(utils.stream_llm_response(chat_message, llm_resp))
     except Exception as e:
-        # If quota error and the intent is department listing, try CSV direct fallback
-        err_msg = str(e)
-        # If off-topic (e.g., 天気/雑談) and quota error, prefer fixed message over fallbacks
-        if (
-            not getattr(ct, "ALLOW_OFFTOPIC_LLM", True)
-            and hasattr(cp, "_looks_unrelated_to_corp_docs")
-            and cp._looks_unrelated_to_corp_docs(chat_message, [])
-        ):
-            with st.chat_message("assistant"):
-                if mode == ct.ANSWER_MODE_1:
-                    fixed = "入力内容と関連する社内文書が見つかりませんでした"
-                else:
-                    fixed = getattr(ct, "INQUIRY_NO_MATCH_ANSWER", "回答に必要な情報が見つかりませんでした。")
-                st.warning(fixed)
-            st.stop()
-        # Dept listing offline fallback
-        if cp.detect_dept_listing(chat_message, dept_name=None) and (
-            "insufficient_quota" in err_msg or "You exceeded your current quota" in err_msg or "Error code: 429" in err_msg
-        ):
-            with st.chat_message("assistant"):
-                # infer department name
-                dept = cp.get_department_from_prompt(chat_message) or "人事部"
-                rendered = cp.render_department_listing_from_data_root(dept, min_rows=4)
-                if not rendered:
-                    st.warning("部署一覧のCSV検索に失敗しました。")
-            st.stop()
-        # If quota error for general query, try naive keyword search fallback
-        if "insufficient_quota" in err_msg or "You exceeded your current quota" in err_msg or "Error code: 429" in err_msg:
-            with st.chat_message("assistant"):
-                rendered = cp.render_keyword_search_fallback(chat_message, max_hits=5)
-                if not rendered:
-                    st.error(utils.build_error_message(f"エラーが発生しました: {e}"))
-            st.stop()
-        # Otherwise, show normal error
-        st.error(utils.build_error_message(f"エラーが発生しました: {e}"))
+        answer_slot.empty()
+        # Fallbacks (off-topic message, CSV listing, keyword search) or a plain error
+        cp.handle_llm_error(e, chat_message, mode)
         st.stop()
 
-    with st.chat_message("assistant"):
+    with answer_slot.container(), st.chat_message("assistant"):
         if mode == ct.ANSWER_MODE_1:
             content = cp.display_search_llm_response(llm_resp)
         else:
             content = cp.display_contact_llm_response(llm_resp)
-    # Append assistant message to log
-    try:
-        # Fallback to a short placeholder when content is empty
-        safe_content = content if isinstance(content, str) and content.strip() else "参照ドキュメントを表示しました。"
-        st.session_state.messages.append({"role": "assistant", "content": safe_content})
-    except Exception:
-        pass
\ No newline at end of file
+    # Record the answer: shown text for the log, LLM answer for the next turns' chat history
+    # Fallback to a short placeholder when content is empty
+    turn["assistant"] = content if isinstance(content, str) and content.strip() else "参照ドキュメントを表示しました。"
+    answer = llm_resp.get("answer", "")
+    turn["answer"] = answer if isinstance(answer, str) else ""
\ No newline at end of file
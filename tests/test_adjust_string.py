@@ -0,0 +1,32 @@
+"""Windows text normalization in initialize._adjust_string."""
+
+import unicodedata
+
+import pytest
+
+pytest.importorskip("streamlit")
+pytest.importorskip("langchain_community")
+
+import initialize as init  # noqa: E402
+
+
+def _round_trip(s: str) -> str:
+    # Original implementation: NFC, then drop anything cp932 cannot encode
+    return unicodedata.normalize("NFC", s).encode("cp932", "ignore").decode("cp932")
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "9:00〜18:00",  # U+301C WAVE DASH
+        "−5℃",  # U+2212 MINUS SIGN
+        "A‖B",  # U+2016 DOUBLE VERTICAL LINE
+        "¢ £ ¬",
+        "株主優待について",  # no folding needed
+        "絵文字😀を含む 〜",  # not encodable: slow path
+        "é",  # needs NFC
+    ],
+)
+def test_adjust_string_matches_cp932_round_trip(monkeypatch, text):
+    monkeypatch.setattr(init, "_IS_WIN", True)
+    assert init._adjust_string(text) == _round_trip(text)
@@ -0,0 +1,18 @@
+"""Keyword search fallback (no LLM) over the files shipped under data/."""
+
+import os
+
+import pytest
+
+pytest.importorskip("streamlit")
+pytest.importorskip("langchain_community")
+
+import components as cp  # noqa: E402
+
+REPO_ROOT = os.path.join(os.path.dirname(__file__), "..")
+
+
+def test_csv_query_in_loader_format_is_found(monkeypatch):
+    # CSVLoader renders rows as "列名: 値" lines, which never appear in the raw CSV bytes
+    monkeypatch.chdir(REPO_ROOT)
+    assert cp.render_keyword_search_fallback("部署: 人事部", max_hits=5)
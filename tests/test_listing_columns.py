@@ -0,0 +1,24 @@
+"""Department listing columns picked for the roster CSV shipped under data/."""
+
+import csv
+import os
+
+import pytest
+
+pytest.importorskip("streamlit")
+
+import components as cp  # noqa: E402
+
+ROSTER_CSV = os.path.join(os.path.dirname(__file__), "..", "data", "社員について", "社員名簿.csv")
+
+
+def test_listing_columns_for_shipped_roster():
+    with open(ROSTER_CSV, encoding="utf-8-sig", newline="") as f:
+        header = next(csv.reader(f))
+    keep = cp._listing_columns(header)
+    assert keep == ["社員ID", "氏名（フルネーム）", "メールアドレス", "部署", "役職"]
+
+
+def test_listing_columns_keeps_all_when_roster_not_recognized():
+    cols = ["a", "部署", "b"]
+    assert cp._listing_columns(cols) == cols
@@ -5,27 +5,44 @@ Clean, ASCII-safe, and compatible with LangChain 0.3.x.
 
 from __future__ import annotations
 
-from dotenv import load_dotenv
+import hashlib
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import TYPE_CHECKING
+
 import streamlit as st
 
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain_core.messages import HumanMessage, AIMessage
-from langchain_openai import ChatOpenAI
-from langchain.chains import (
-    create_history_aware_retriever,
-    create_retrieval_chain,
-)
-from langchain.chains.combine_documents import create_stuff_documents_chain
 
 import constants as ct
 
+if TYPE_CHECKING:
+    # Imported on first use (langchain_openai / langchain.chains are slow to import)
+    from langchain_openai import ChatOpenAI
 
-# Load environment variables if present
-load_dotenv()
+
+def _chat_prompt(system_template: str) -> ChatPromptTemplate:
+    return ChatPromptTemplate.from_messages(
+        [
+            ("system", system_template),
+            MessagesPlaceholder("chat_history"),
+            ("human", "{input}"),
+        ]
+    )
+
+
+# Prompts are static, so they are built once at import
+# Prompt to create independent question based on history
+_QG_PROMPT = _chat_prompt(ct.SYSTEM_PROMPT_CREATE_INDEPENDENT_TEXT)
+# Answer prompt depends on app mode
+_QA_PROMPT_SEARCH = _chat_prompt(ct.SYSTEM_PROMPT_DOC_SEARCH)
+_QA_PROMPT_INQUIRY = _chat_prompt(ct.SYSTEM_PROMPT_INQUIRY)
 
 
 def get_source_icon(source: str) -> str:
-    if isinstance(source, str) and source.startswith("http"):
+    if isinstance(source, str) and source.startswith(ct.URL_PREFIXES):
         return ct.LINK_SOURCE_ICON
     return ct.DOC_SOURCE_ICON
 
@@ -40,109 +57,268 @@ def get_llm_response(chat_message: str):
     Returns a dict like {"answer": str, "context": List[Document], ...}
     so that UI can render both text and sources.
     """
-    # Initialize LLM (LangChain 0.3 expects `model` param)
-    llm = ChatOpenAI(model=ct.MODEL, temperature=ct.TEMPERATURE)
+    result: dict = {}
+    for _ in stream_llm_response(chat_message, result):
+        pass
+    return result
+
 
-    # Optional: agent-based flow with max_iterations guard
+def stream_llm_response(chat_message: str, result: dict):
+    """Same as get_llm_response, but yield answer text fragments as they are generated.
+
+    `result` is filled in place with the response dict ("answer", "context", ...);
+    it is complete once the generator is exhausted.
+    """
+    # Optional: agent-based flow with max_iterations guard (not streamed)
     if getattr(ct, "USE_AGENT", False):
-        agent_res = _try_agent_answer(chat_message, llm)
+        agent_res = _try_agent_answer(chat_message)
         if agent_res is not None:
-            # Maintain chat history as LC messages (human + ai)
-            st.session_state.chat_history = st.session_state.get("chat_history", [])
-            st.session_state.chat_history.append(HumanMessage(content=chat_message))
+            result.update(agent_res)
             ans_text = agent_res.get("answer", "")
-            if isinstance(ans_text, str):
-                st.session_state.chat_history.append(AIMessage(content=ans_text))
-            return agent_res
-
-    # Prompt to create independent question based on history
-    qg_template = ct.SYSTEM_PROMPT_CREATE_INDEPENDENT_TEXT
-    qg_prompt = ChatPromptTemplate.from_messages(
-        [
-            ("system", qg_template),
-            MessagesPlaceholder("chat_history"),
-            ("human", "{input}"),
-        ]
-    )
-
-    # Answer prompt depends on app mode
-    qa_template = (
-        ct.SYSTEM_PROMPT_DOC_SEARCH
-        if st.session_state.get("mode") == ct.ANSWER_MODE_1
-        else ct.SYSTEM_PROMPT_INQUIRY
-    )
-    qa_prompt = ChatPromptTemplate.from_messages(
-        [
-            ("system", qa_template),
-            MessagesPlaceholder("chat_history"),
-            ("human", "{input}"),
-        ]
-    )
+            if isinstance(ans_text, str) and ans_text:
+                yield ans_text
+            return
 
     # Build chain with retriever if available; fallback to LLM only
     retriever = st.session_state.get("retriever")
-    if retriever is not None:
-        history_aware_retriever = create_history_aware_retriever(
-            llm, retriever, qg_prompt
+    mode = st.session_state.get("mode")
+    # Only the latest turns go into the prompts, so token cost stays bounded on long sessions
+    chat_history = _recent_history(int(getattr(ct, "MAX_HISTORY_TURNS", 8)))
+
+    # Same question in the same context: replay the stored answer instead of calling the LLM
+    # (not with the agent enabled, whose tool calls can give different answers)
+    use_cache = not getattr(ct, "USE_AGENT", False)
+    cache_key = _response_cache_key(mode, chat_message, chat_history, retriever)
+    cached = _response_cache().get(cache_key) if use_cache else None
+    if cached is not None:
+        result.update(cached)
+        if result.get("answer"):
+            yield result["answer"]
+    else:
+        chain = _get_chain(mode, id(retriever), retriever)
+        no_match = (
+            ct.NO_DOC_MATCH_ANSWER if mode == ct.ANSWER_MODE_1 else ct.INQUIRY_NO_MATCH_ANSWER
         )
-        doc_chain = create_stuff_documents_chain(llm, qa_prompt)
-        chain = create_retrieval_chain(history_aware_retriever, doc_chain)
-        # Retrieval chain will populate 'context' for doc_chain. Provide inputs expected by prompts.
-        result = chain.invoke({
-            "input": chat_message,
-            "chat_history": st.session_state.get("chat_history", []),
-        })
+        yield from _stream_chain(
+            chain, retriever is not None, chat_message, chat_history, result, no_match
+        )
+        if use_cache:
+            # Only the answer and its sources: "chat_history" is this session's own list
+            _response_cache().put(cache_key, {k: result[k] for k in ("answer", "context") if k in result})
+
+
+def _recent_history(max_turns: int) -> list:
+    """Chat history for the prompts from st.session_state.turns, oldest first.
+
+    ("human" | "ai", text) tuples (MessagesPlaceholder converts them to messages itself) for
+    the last max_turns turns the LLM answered; the turn being asked is not answered yet.
+    """
+    if max_turns <= 0:
+        return []
+    pairs = []
+    for turn in reversed(st.session_state.get("turns", [])):
+        answer = turn.get("answer")
+        if answer is None:
+            continue
+        pairs.append(("ai", answer))
+        pairs.append(("human", turn["user"]))
+        if len(pairs) >= 2 * max_turns:
+            break
+    pairs.reverse()
+    return pairs
+
+
+def _stream_chain(
+    chain, with_retriever: bool, chat_message: str, chat_history, result: dict, no_match: str
+):
+    """Stream answer fragments from the chain built by _get_chain, filling result in place.
+
+    When retrieval finds no documents, no_match is the answer and the LLM is not called.
+    """
+    answer_parts = []
+    if with_retriever:
+        # Same steps as create_retrieval_chain, run one by one to skip the LLM without documents
+        history_aware_retriever, doc_chain = chain
+        inputs = {"input": chat_message, "chat_history": chat_history}
+        docs = history_aware_retriever.invoke(inputs)
+        result.update(inputs, context=docs)
+        if not docs:
+            result["answer"] = no_match
+            yield no_match
+            return
+        for piece in doc_chain.stream({**inputs, "context": docs}):
+            answer_parts.append(piece)
+            yield piece
+        result["answer"] = "".join(answer_parts)
     else:
         # No retriever: answer with LLM only using qa_prompt
         # qa_prompt expects a 'context' variable; supply empty string when retriever is unavailable
-        direct_chain = qa_prompt | llm
-        answer_text = direct_chain.invoke({
-            "input": chat_message,
-            "chat_history": st.session_state.get("chat_history", []),
-            "context": "",
-        })
+        for chunk in chain.stream({"input": chat_message, "chat_history": chat_history, "context": ""}):
+            piece = chunk.content if hasattr(chunk, "content") else str(chunk)
+            answer_parts.append(piece)
+            yield piece
         # Normalize to expected dict shape
-        normalized_answer = (
-            answer_text.content if hasattr(answer_text, "content") else str(answer_text)
-        )
-        result = {"answer": normalized_answer, "context": []}
+        result.update({"answer": "".join(answer_parts), "context": []})
 
-    # Maintain chat history as LangChain messages
-    st.session_state.chat_history = st.session_state.get("chat_history", [])
-    st.session_state.chat_history.append(HumanMessage(content=chat_message))
-    answer_text = result.get("answer", "")
-    if isinstance(answer_text, str):
-        st.session_state.chat_history.append(AIMessage(content=answer_text))
 
-    return result
+def _response_cache_key(mode, chat_message: str, chat_history, retriever) -> tuple:
+    """(mode, retriever, sha1 of the NFKC/lower-cased question, sha1 of the chat history)."""
+    query = unicodedata.normalize("NFKC", chat_message).strip().lower()
+    history = hashlib.sha1()
+    for role, text in chat_history:
+        history.update(f"{role}\0{text}\0".encode("utf-8"))
+    return (
+        mode,
+        id(retriever),
+        hashlib.sha1(query.encode("utf-8")).hexdigest(),
+        history.hexdigest(),
+    )
 
 
-def _try_agent_answer(chat_message: str, llm: ChatOpenAI):
-    """Run an agent with a retrieval tool under a strict iteration cap.
+class _ResponseCache:
+    """Thread-safe LRU of response dicts with a TTL, shared by all sessions."""
 
-    Returns result dict on success, or None to let callers fallback to normal flow.
+    def __init__(self, max_entries: int, ttl: float):
+        self._max_entries = max_entries
+        self._ttl = ttl
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key) -> dict | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            stored_at, value = entry
+            if time.monotonic() - stored_at > self._ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return dict(value)
+
+    def put(self, key, value: dict) -> None:
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+
+@st.cache_resource(show_spinner=False)
+def _response_cache() -> _ResponseCache:
+    return _ResponseCache(
+        int(getattr(ct, "RESPONSE_CACHE_MAX_ENTRIES", 512)),
+        float(getattr(ct, "RESPONSE_CACHE_TTL", 3600)),
+    )
+
+
+@st.cache_resource(show_spinner=False)
+def _get_llm(model: str, temperature: float) -> ChatOpenAI:
+    """Shared ChatOpenAI client, so the HTTP connection pool survives reruns."""
+    from langchain_openai import ChatOpenAI
+
+    # LangChain 0.3 expects `model` param
+    return ChatOpenAI(model=model, temperature=temperature, streaming=True)
+
+
+@st.cache_resource(show_spinner=False)
+def _get_chain(mode, retriever_id: int, _retriever):
+    """Answer chain for (mode, retriever); keyed by id() since retrievers are not hashable.
+
+    With a retriever: (history-aware retriever, stuff-documents chain), run by _stream_chain.
+    Without one: qa_prompt | llm (the prompt's 'context' is then supplied by the caller).
+    """
+    llm = _get_llm(ct.MODEL, ct.TEMPERATURE)
+    qa_prompt = _QA_PROMPT_SEARCH if mode == ct.ANSWER_MODE_1 else _QA_PROMPT_INQUIRY
+    if _retriever is None:
+        return qa_prompt | llm
+
+    from langchain.chains import create_history_aware_retriever
+    from langchain.chains.combine_documents import create_stuff_documents_chain
+
+    history_aware_retriever = create_history_aware_retriever(llm, _retriever, _QG_PROMPT)
+    doc_chain = create_stuff_documents_chain(llm, qa_prompt)
+    return history_aware_retriever, doc_chain
+
+
+@st.cache_resource(show_spinner=False)
+def _get_encoder(model: str):
+    """tiktoken encoding for model.
+
+    Import / download errors propagate so they are not cached; the next call retries.
     """
+    import tiktoken
+
     try:
-        from langchain.tools import Tool
-        from langchain.agents import create_react_agent, AgentExecutor
-        from langchain_core.prompts import ChatPromptTemplate
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        # Model name unknown to this tiktoken version
+        return tiktoken.get_encoding("o200k_base")
+
+
+def _truncate_tool_docs(docs) -> str:
+    """Join doc texts for the agent, each cut to AGENT_TOOL_DOC_TOKENS and all to AGENT_TOOL_TOTAL_TOKENS."""
+    per_doc = int(getattr(ct, "AGENT_TOOL_DOC_TOKENS", 300))
+    budget = int(getattr(ct, "AGENT_TOOL_TOTAL_TOKENS", 1200))
+    try:
+        enc = _get_encoder(ct.MODEL)
     except Exception:
-        return None
+        # tiktoken missing or its encoding files unavailable
+        enc = None
+    parts = []
+    for d in docs:
+        if budget <= 0:
+            break
+        txt = str(getattr(d, "page_content", ""))
+        limit = min(per_doc, budget)
+        if enc is None:
+            # Without tiktoken fall back to characters
+            txt = txt[:limit]
+            budget -= len(txt)
+        else:
+            toks = enc.encode(txt)[:limit]
+            # A cut inside a multi-byte character decodes to U+FFFD; drop it
+            txt = enc.decode(toks).rstrip("\ufffd")
+            budget -= len(toks)
+        parts.append(txt)
+    return "\n\n".join(parts)
+
+
+def _try_agent_answer(chat_message: str):
+    """Run an agent with a retrieval tool under a strict iteration cap.
 
+    Returns result dict on success, or None to let callers fallback to normal flow.
+    """
+    if not getattr(ct, "USE_AGENT", False):
+        return None
     retriever = st.session_state.get("retriever")
     if retriever is None:
         return None
 
+    try:
+        executor = _get_agent_executor(id(retriever), retriever)
+        res = executor.invoke({"input": chat_message})
+        output = res.get("output") or res.get("final_output") or ""
+        return {"answer": output, "context": []}
+    except Exception:
+        return None
+
+
+@st.cache_resource(show_spinner=False)
+def _get_agent_executor(retriever_id: int, _retriever):
+    """ReAct agent executor searching _retriever; keyed by id() like _get_chain.
+
+    Import / build errors propagate so they are not cached; _try_agent_answer falls back.
+    """
+    from langchain.tools import Tool
+    from langchain.agents import create_react_agent, AgentExecutor
+
     def search_tool_run(q: str) -> str:
         try:
-            docs = retriever.get_relevant_documents(q)
+            docs = _retriever.invoke(q)
         except Exception:
             return ""
-        parts = []
-        for d in docs[: int(getattr(ct, "RETRIEVAL_TOP_K", 5))]:
-            txt = str(getattr(d, "page_content", ""))
-            parts.append(txt[:500])
-        return "\n\n".join(parts) if parts else ""
+        return _truncate_tool_docs(docs[: int(getattr(ct, "RETRIEVAL_TOP_K", 5))])
 
     tool = Tool(
         name="search_corpus",
@@ -165,17 +341,11 @@ def _try_agent_answer(chat_message: str, llm: ChatOpenAI):
         ]
     )
 
-    try:
-        agent = create_react_agent(llm, [tool], prompt)
-        executor = AgentExecutor(
-            agent=agent,
-            tools=[tool],
-            max_iterations=int(getattr(ct, "MAX_AGENT_ITERATIONS", 3)),
-            early_stopping_method=getattr(ct, "AGENT_EARLY_STOP_METHOD", "generate"),
-            verbose=False,
-        )
-        res = executor.invoke({"input": chat_message})
-        output = res.get("output") or res.get("final_output") or ""
-        return {"answer": output, "context": []}
-    except Exception:
-        return None
\ No newline at end of file
+    agent = create_react_agent(_get_llm(ct.MODEL, ct.TEMPERATURE), [tool], prompt)
+    return AgentExecutor(
+        agent=agent,
+        tools=[tool],
+        max_iterations=int(getattr(ct, "MAX_AGENT_ITERATIONS", 3)),
+        early_stopping_method=getattr(ct, "AGENT_EARLY_STOP_METHOD", "generate"),
+        verbose=False,
+    )